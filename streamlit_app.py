@@ -1,6 +1,11 @@
+import codecs
 import os
 import re
+import tarfile
+import time
 import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 import streamlit as st
 from io import BytesIO
 from googletrans import Translator
@@ -8,9 +13,19 @@ import json
 import logging
 
 CONFIG_PATH = "novel_splitter_config.json"
+ARCHIVE_FORMATS = {"zip": "application/zip", "tar.gz": "application/gzip"}
+# Each cached decode/split holds a full copy of a novel, so keep few.
+CACHE_MAX_ENTRIES = 4
+# Upper bound on the joined title text sent in one translation request.
+TRANSLATE_BATCH_CHARS = 4000
+# Below this many chapters, ZIP entries are deflated sequentially.
+PARALLEL_MIN_CHAPTERS = 64
+
+_FILENAME_DELETE = str.maketrans("", "", '\\/:*?"<>|')
 
 # --- Logger Setup ---
 LOG_LEVELS = ["NONE", "ERROR", "WARNING", "INFO", "DEBUG"]
+logger = logging.getLogger(__name__)
 
 
 def log(msg, level="INFO"):
@@ -27,6 +42,12 @@ def setup_logging(selected_level):
         format="%(asctime)s - %(levelname)s - %(message)s",
         level=getattr(logging, selected_level, logging.INFO),
     )
+    # Hot loops log through `logger` directly and check isEnabledFor first,
+    # so it must honour "NONE" as well.
+    if selected_level == "NONE":
+        logger.setLevel(logging.CRITICAL + 1)
+    else:
+        logger.setLevel(getattr(logging, selected_level, logging.INFO))
 
 
 # --- Config I/O ---
@@ -34,9 +55,11 @@ def load_config():
     default_config = {
         "chapter_marker": r"^(?P<full>第\s*[\d０-９一二三四五六七八九十百千万零〇]+[章回]\s*[^\n\r]*)",
         "book_title_marker": r"(?:『)?(?P<title>[^\n/／]+)[/／](?:作者[:：])?(?P<author>[^\n』]+)(?:』)?|^(?P<title_alt>.+)[\r\n]+作者[:：](?P<author_alt>.+)",
-        "summary_marker": r"(?:内容简介|简介)[:：]?\s*(?P<summary>.+?)(?=\n+第[\d一二三四五六七八九十百千万零〇]+章|\n*$)",
+        "summary_marker": r"(?:内容简介|简介)[:：]?\s*(?P<summary>[^\n]*(?:\n(?!第[\d一二三四五六七八九十百千万零〇]+[章回])[^\n]*)*)",
         "log_level": "INFO",
         "translate_titles": False,
+        "compress_level": 1,
+        "archive_format": "zip",
     }
     if os.path.exists(CONFIG_PATH):
         try:
@@ -55,14 +78,106 @@ def save_config(config):
 
 
 def sanitize_filename(name):
-    return re.sub(r'[\\/:*?"<>|]+', "", name)
+    return name.translate(_FILENAME_DELETE)
+
+
+def _safe_translate(translator, title):
+    try:
+        return translator.translate(title, src="zh-cn", dest="en").text.strip()
+    except Exception as e:
+        log(f"Chapter title translation failed: {e}", "WARNING")
+        return title
+
+
+def _title_batches(titles, max_chars=TRANSLATE_BATCH_CHARS):
+    batch, size = [], 0
+    for title in titles:
+        if batch and size + len(title) + 1 > max_chars:
+            yield batch
+            batch, size = [], 0
+        batch.append(title)
+        size += len(title) + 1
+    if batch:
+        yield batch
+
+
+def _translate_batch(translator, titles):
+    # translate() only accepts a single string, so send the titles as one
+    # newline-joined request and split the result back apart.
+    try:
+        lines = translator.translate(
+            "\n".join(titles), src="zh-cn", dest="en"
+        ).text.split("\n")
+    except Exception as e:
+        log(f"Batch title translation failed: {e}", "WARNING")
+        return None
+    if len(lines) != len(titles):
+        log("Batch title translation did not keep one line per title.", "WARNING")
+        return None
+    return [line.strip() for line in lines]
+
+
+def chapter_filenames(titles, translator=None):
+    if translator and titles:
+        translated = []
+        batching = True
+        # Each request mostly waits on the network, so threads overlap well.
+        with ThreadPoolExecutor(max_workers=16) as ex:
+            for batch in _title_batches(titles):
+                result = _translate_batch(translator, batch) if batching else None
+                if result is None:
+                    # Once a batch has come back misaligned, stop paying for
+                    # batch requests and translate the rest per title.
+                    batching = False
+                    result = list(
+                        ex.map(lambda t: _safe_translate(translator, t), batch)
+                    )
+                translated.extend(result)
+        titles = translated
+    return [sanitize_filename(title) + ".txt" for title in titles]
+
+
+_BOMS = (
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+)
+_ASCII_BYTES = bytes(range(128))
+
+
+def fast_detect(raw, sample_size=4096):
+    # UTF-32 BOMs must be checked before UTF-16, which shares the FF FE prefix.
+    for bom, encoding in _BOMS:
+        if raw.startswith(bom):
+            return encoding, 1.0
+    if not raw[:sample_size].translate(None, _ASCII_BYTES):
+        return "utf-8", 1.0
+    return None
 
 
-def try_decode_until_marker(raw, encodings, marker_regex):
+def probe_decode(raw, enc, sample_size=4096):
+    # Decode incrementally so a multi-byte character cut at the sample
+    # boundary is not mistaken for invalid input.
+    sample = memoryview(raw)[:sample_size]
+    codecs.getincrementaldecoder(enc)().decode(sample, final=False)
+
+
+def compile_markers(config):
+    return {
+        "chapter": re.compile(config["chapter_marker"], re.M),
+        "title": re.compile(config["book_title_marker"], re.M),
+        "summary": re.compile(config["summary_marker"], re.S),
+    }
+
+
+def try_decode_until_marker(raw, encodings, marker_re):
     for enc in encodings:
         try:
+            probe_decode(raw, enc)
             text = raw.decode(enc)
-            if re.search(marker_regex, text, re.M):
+            if marker_re.search(text):
                 log(f"Decoded using encoding: {enc}", "INFO")
                 return text, enc
         except Exception as e:
@@ -70,10 +185,18 @@ def try_decode_until_marker(raw, encodings, marker_regex):
     return None, None
 
 
-def split_novel(text, chapter_marker, book_title_marker, summary_marker):
+def get_preamble(text, chapter_regex):
+    # Title, author and summary come before the first chapter heading, so
+    # there is no need to run those patterns over the whole novel.
+    first_chapter = chapter_regex.search(text)
+    return text[: first_chapter.start()] if first_chapter else text[:8192]
+
+
+def split_novel(text, chapter_regex, title_regex, summary_regex):
     log("Splitting novel...", "INFO")
 
-    title_match = re.search(book_title_marker, text, re.M)
+    preamble = get_preamble(text, chapter_regex)
+    title_match = title_regex.search(preamble)
     if title_match:
         g = title_match.groupdict()
         book_name = g.get("title") or g.get("title_alt") or "UnknownBook"
@@ -84,7 +207,7 @@ def split_novel(text, chapter_marker, book_title_marker, summary_marker):
         book_name = "UnknownBook"
         author = "UnknownAuthor"
 
-    summary_match = re.search(summary_marker, text, re.S)
+    summary_match = summary_regex.search(preamble)
     summary = (
         summary_match.groupdict().get("summary", "").strip() if summary_match else ""
     )
@@ -94,20 +217,21 @@ def split_novel(text, chapter_marker, book_title_marker, summary_marker):
     else:
         log("Summary extracted.", "INFO")
 
-    chapter_regex = re.compile(chapter_marker, re.M)
     matches = list(chapter_regex.finditer(text))
     if not matches:
         log("No chapters found.", "ERROR")
         raise Exception("未找到章节内容起始标记 (chapter start marker not found)")
 
+    # Chapters are (title, body_start, body_end) offsets into `text`; bodies
+    # are sliced out only when they are written.
     chapters = []
     for i, match in enumerate(matches):
         start = match.end()
         end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
         title = match.group("full").strip()
-        body = text[start:end].strip()
-        log(f"Found chapter {i+1}: {title}", "DEBUG")
-        chapters.append({"title": title, "body": body})
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Found chapter %d: %s", i + 1, title)
+        chapters.append((title, start, end))
 
     log(f"Total chapters extracted: {len(chapters)}", "INFO")
 
@@ -115,13 +239,145 @@ def split_novel(text, chapter_marker, book_title_marker, summary_marker):
         "meta": {
             "bookName": book_name,
             "author": author,
-            "latestChapter": chapters[-1]["title"] if chapters else "",
+            "latestChapter": chapters[-1][0] if chapters else "",
             "summary": summary,
         },
         "chapters": chapters,
     }
 
 
+def info_text(meta):
+    return f"书名: {meta['bookName']}\n作者: {meta['author']}\n更新至: {meta['latestChapter']}\n简介:\n{meta['summary']}\n"
+
+
+def deflate_chapter(title, body, compress_level):
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    crc = file_size = 0
+    chunks = []
+    for piece in (title.encode("utf-8"), b"\n", body.encode("utf-8"), b"\n"):
+        crc = zlib.crc32(piece, crc)
+        file_size += len(piece)
+        chunks.append(compressor.compress(piece))
+    chunks.append(compressor.flush())
+    return file_size, crc, b"".join(chunks)
+
+
+def write_deflated(zipf, name, file_size, crc, payload):
+    # Append an entry whose raw deflate stream is already computed, the same
+    # way ZipFile.mkdir writes a header; close() writes the central directory.
+    zinfo = zipfile.ZipInfo(name, date_time=time.localtime(time.time())[:6])
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.external_attr = 0o600 << 16
+    zinfo.file_size = file_size
+    zinfo.compress_size = len(payload)
+    zinfo.CRC = crc
+    zipf.fp.seek(zipf.start_dir)
+    zinfo.header_offset = zipf.fp.tell()
+    zipf._writecheck(zinfo)
+    zipf._didModify = True
+    zipf.fp.write(zinfo.FileHeader())
+    zipf.fp.write(payload)
+    zipf.filelist.append(zinfo)
+    zipf.NameToInfo[zinfo.filename] = zinfo
+    zipf.start_dir = zipf.fp.tell()
+
+
+def build_zip(text, meta, chapters, fnames, compress_level):
+    zip_buffer = BytesIO()
+    cpu_count = os.cpu_count() or 1
+
+    def deflate(ch):
+        title, start, end = ch
+        return deflate_chapter(title, text[start:end].strip(), compress_level)
+
+    # The executor only starts threads once work is submitted to it.
+    with zipfile.ZipFile(
+        zip_buffer, "w", zipfile.ZIP_DEFLATED, compresslevel=compress_level
+    ) as zipf, ThreadPoolExecutor(max_workers=cpu_count) as ex:
+        zipf.writestr("info.txt", info_text(meta))
+        # zlib releases the GIL while deflating, so chapters can compress in
+        # parallel threads; on one core or a short book the pool costs more
+        # than it saves. Either way entries are appended in order.
+        if cpu_count > 1 and len(chapters) >= PARALLEL_MIN_CHAPTERS:
+            deflated = ex.map(deflate, chapters)
+        else:
+            deflated = map(deflate, chapters)
+        for fname, (file_size, crc, payload) in zip(fnames, deflated):
+            write_deflated(zipf, fname, file_size, crc, payload)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Wrote: %s", fname)
+    return zip_buffer
+
+
+class _PiecesReader:
+    # Minimal file object that tarfile.addfile can read a list of byte
+    # strings from, in order, without joining them into one buffer.
+    def __init__(self, pieces):
+        self._pieces = [memoryview(p) for p in pieces if p]
+
+    def read(self, size):
+        out = []
+        while size and self._pieces:
+            piece = self._pieces[0]
+            out.append(piece[:size])
+            if len(piece) > size:
+                self._pieces[0] = piece[size:]
+                size = 0
+            else:
+                self._pieces.pop(0)
+                size -= len(piece)
+        return b"".join(out)
+
+
+def build_tar_gz(text, meta, chapters, fnames, compress_level):
+    # One gzip stream over the whole tar shares the compression window
+    # across chapters, unlike a ZIP's per-entry deflate streams.
+    tar_buffer = BytesIO()
+    mtime = time.time()
+
+    def add(tf, name, pieces):
+        info = tarfile.TarInfo(name=name)
+        info.size = sum(len(p) for p in pieces)
+        info.mtime = mtime
+        tf.addfile(info, _PiecesReader(pieces))
+
+    with tarfile.open(
+        fileobj=tar_buffer, mode="w:gz", compresslevel=compress_level
+    ) as tf:
+        add(tf, "info.txt", [info_text(meta).encode("utf-8")])
+        for (title, start, end), fname in zip(chapters, fnames):
+            body = text[start:end].strip()
+            add(tf, fname, [title.encode("utf-8"), b"\n", body.encode("utf-8"), b"\n"])
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Wrote: %s", fname)
+    return tar_buffer
+
+
+# Streamlit reruns main() on every widget change; cache the expensive
+# decode and split steps on their inputs so one upload is parsed once.
+# The marker strings form the cache key; the compiled `_markers` from
+# main() are passed through unhashed.
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def cached_decode(raw, chapter_marker, _markers):
+    # GB18030 is a superset of GBK and GB2312, so it covers both.
+    encodings_to_try = ["gb18030", "utf-8", "big5", "utf-16", "utf-32"]
+    fast = fast_detect(raw)
+    if fast:
+        detected = fast[0]
+        log(f"Detected encoding: {detected}", "DEBUG")
+        encodings_to_try = [detected] + [
+            enc for enc in encodings_to_try if enc != detected
+        ]
+    return try_decode_until_marker(raw, encodings_to_try, _markers["chapter"])
+
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def cached_split(text, chapter_marker, book_title_marker, summary_marker, _markers):
+    return split_novel(
+        text, _markers["chapter"], _markers["title"], _markers["summary"]
+    )
+
+
 def main():
     global log_level
     config = load_config()
@@ -139,6 +395,14 @@ def main():
     config["translate_titles"] = st.sidebar.checkbox(
         "Translate chapter titles to English?", value=config["translate_titles"]
     )
+    config["archive_format"] = st.sidebar.selectbox(
+        "Archive Format",
+        list(ARCHIVE_FORMATS),
+        index=list(ARCHIVE_FORMATS).index(config["archive_format"]),
+    )
+    config["compress_level"] = st.sidebar.slider(
+        "Compression Level", 0, 9, value=config["compress_level"]
+    )
     config["chapter_marker"] = st.sidebar.text_area(
         "Chapter Marker (Regex)", config["chapter_marker"], height=70
     )
@@ -157,14 +421,20 @@ def main():
     log_level = new_log_level
     setup_logging(log_level)
 
+    try:
+        markers = compile_markers(config)
+    except re.error as e:
+        log(f"Invalid marker regex: {e}", "ERROR")
+        st.error(f"❌ Invalid regex in configuration: {e}")
+        return
+
     uploaded_file = st.file_uploader("📤 Upload a `.txt` Chinese novel", type=["txt"])
-    encodings_to_try = ["gb18030", "gbk", "gb2312", "utf-8", "big5", "utf-16", "utf-32"]
 
     if uploaded_file:
-        raw = uploaded_file.read()
-        text, encoding = try_decode_until_marker(
-            raw, encodings_to_try, config["chapter_marker"]
-        )
+        # getvalue() returns the whole upload regardless of the stream
+        # position, unlike read(), across Streamlit reruns.
+        raw = uploaded_file.getvalue()
+        text, encoding = cached_decode(raw, config["chapter_marker"], markers)
         if not text:
             st.error("❌ Failed to decode text. Adjust encoding or markers.")
             return
@@ -173,9 +443,10 @@ def main():
 
         # --- Live Preview ---
         st.subheader("🧪 Regex Match Preview")
+        preamble = get_preamble(text, markers["chapter"])
 
         with st.expander("📘 Title & Author Match", expanded=False):
-            title_match = re.search(config["book_title_marker"], text, re.M)
+            title_match = markers["title"].search(preamble)
             if title_match:
                 g = title_match.groupdict()
                 st.markdown(f"**Title:** {g.get('title') or g.get('title_alt')}")
@@ -184,7 +455,7 @@ def main():
                 st.warning("No match found for title/author.")
 
         with st.expander("📖 Summary Match", expanded=False):
-            summary_match = re.search(config["summary_marker"], text, re.S)
+            summary_match = markers["summary"].search(preamble)
             summary = (
                 summary_match.groupdict().get("summary", "").strip()
                 if summary_match
@@ -200,11 +471,14 @@ def main():
                 st.warning("No summary matched.")
 
         with st.expander("📚 Chapter Title Matches", expanded=False):
-            chapter_regex = re.compile(config["chapter_marker"], re.M)
-            matches = list(chapter_regex.finditer(text))
-            total_chapters = len(matches)
-            if matches:
-                for i, match in enumerate(matches[:3]):
+            preview_matches = []
+            total_chapters = 0
+            for match in markers["chapter"].finditer(text):
+                if total_chapters < 3:
+                    preview_matches.append(match)
+                total_chapters += 1
+            if preview_matches:
+                for i, match in enumerate(preview_matches):
                     st.markdown(f"**Match {i+1}:** `{match.group('full')}`")
                 if total_chapters > 3:
                     st.info(f"Showing 3 of {total_chapters} matches...")
@@ -245,11 +519,12 @@ def main():
 
         if st.button("📚 Split Book"):
             try:
-                result = split_novel(
+                result = cached_split(
                     text,
                     config["chapter_marker"],
                     config["book_title_marker"],
                     config["summary_marker"],
+                    markers,
                 )
                 meta = result["meta"]
                 chapters = result["chapters"]
@@ -271,33 +546,22 @@ def main():
                     except Exception as e:
                         log(f"Title translation failed: {e}", "WARNING")
 
-                zip_buffer = BytesIO()
-                with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zipf:
-                    zipf.writestr(
-                        "info.txt",
-                        f"书名: {meta['bookName']}\n作者: {meta['author']}\n更新至: {meta['latestChapter']}\n简介:\n{meta['summary']}\n",
-                    )
-                    for ch in chapters:
-                        try:
-                            fname = ch["title"]
-                            if translator:
-                                fname = translator.translate(
-                                    fname, src="zh-cn", dest="en"
-                                ).text
-                            fname = sanitize_filename(fname) + ".txt"
-                        except Exception as e:
-                            log(f"Chapter title translation failed: {e}", "WARNING")
-                            fname = sanitize_filename(ch["title"]) + ".txt"
-                        content = f"{ch['title']}\n{ch['body']}\n"
-                        zipf.writestr(fname, content)
-                        log(f"Wrote: {fname}", "DEBUG")
+                fnames = chapter_filenames([ch[0] for ch in chapters], translator)
+
+                archive_format = config["archive_format"]
+                build_archive = (
+                    build_tar_gz if archive_format == "tar.gz" else build_zip
+                )
+                archive_buffer = build_archive(
+                    text, meta, chapters, fnames, config["compress_level"]
+                )
 
                 st.success(f"✅ {len(chapters)} chapters split. Ready for download.")
                 st.download_button(
-                    "⬇ Download Chapters ZIP",
-                    data=zip_buffer.getvalue(),
-                    file_name=f"{book_folder}_split.zip",
-                    mime="application/zip",
+                    f"⬇ Download Chapters {archive_format.upper()}",
+                    data=archive_buffer.getvalue(),
+                    file_name=f"{book_folder}_split.{archive_format}",
+                    mime=ARCHIVE_FORMATS[archive_format],
                 )
 
             except Exception as e: